@@ -4,7 +4,7 @@ Session Brain (stateful): ingest events from gateway/dispatcher/orchestrator, de
 and optionally ask Gemini for a root-cause summary.
 
 Run (locally):
-  pip install fastapi uvicorn requests
+  pip install fastapi uvicorn "httpx[http2]" orjson
   uvicorn session_brain_server:app --host 0.0.0.0 --port 9000
 
 Env (optional):
@@ -17,16 +17,29 @@ from __future__ import annotations
 import os
 import time
 import json
+import asyncio
+import logging
+import queue
 import sqlite3
-from typing import Any, Dict, List, Optional
-from collections import deque, defaultdict
-
-import requests
+import threading
+from array import array
+from bisect import bisect_left, insort
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+from dataclasses import dataclass, field
+
+import httpx
+import orjson
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 
 APP_NAME = "session-brain"
+log = logging.getLogger(APP_NAME)
 DB_PATH = os.environ.get("SB_DB_PATH", "/data/session_brain.sqlite3")
+# Max events committed per write transaction by the background writer
+WRITE_BATCH_MAX = int(os.environ.get("SB_WRITE_BATCH_MAX", "500"))
 
 # --- Simple heuristics (tune these) ---
 WINDOW_SEC = int(os.environ.get("SB_WINDOW_SEC", "60"))
@@ -35,6 +48,11 @@ MAX_5XX_PER_WINDOW = int(os.environ.get("SB_MAX_5XX_PER_WINDOW", "15"))
 MAX_TIMEOUTS_PER_WINDOW = int(os.environ.get("SB_MAX_TIMEOUTS_PER_WINDOW", "10"))
 MAX_LATENCY_P95_MS = int(os.environ.get("SB_MAX_LATENCY_P95_MS", "2500"))
 BLOCK_TTL_SEC = int(os.environ.get("SB_BLOCK_TTL_SEC", "900"))
+# How often expired blocks and idle IP windows are reclaimed
+SWEEP_INTERVAL_SEC = int(os.environ.get("SB_SWEEP_INTERVAL_SEC", "30"))
+# Rolling-window p95 uses a 1ms-resolution histogram up to this bound; rarer larger latencies are kept
+# exactly in a sorted overflow list. Capped at 65535 so in-range latencies fit the uint16 ('H') bucket arrays.
+LATENCY_HIST_MAX_MS = min(int(os.environ.get("SB_LATENCY_HIST_MAX_MS", "4096")), 0xFFFF)
 
 # What "disconnect" looks like varies; allow configuring status codes
 DISCONNECT_STATUS = set(
@@ -42,6 +60,9 @@ DISCONNECT_STATUS = set(
     for x in os.environ.get("SB_DISCONNECT_STATUS", "499,502,503,504").split(",")
     if x.strip()
 )
+# Same set as a bitmap, so membership is a shift-and-mask: (_DISCONNECT_BITS >> status) & 1 for status >= 0
+_DISCONNECT_BITS = sum(1 << s for s in DISCONNECT_STATUS if s >= 0)
+_DISCONNECT_SQL = ",".join(str(s) for s in sorted(DISCONNECT_STATUS) if s >= 0)
 
 # --- Gemini (optional) ---
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "").strip()
@@ -51,16 +72,65 @@ GEMINI_ENDPOINT = os.environ.get(
     "https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent",
 ).strip()
 
-app = FastAPI(title=APP_NAME)
+# Owned by the running lifespan, so an app that is started again gets a fresh writer and client.
+_http: Optional[httpx.AsyncClient] = None
+_writer: Optional[threading.Thread] = None
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    global _http, _writer
+    # Shared async client: Gemini calls reuse kept-alive connections (multiplexed over HTTP/2)
+    # instead of paying a TCP+TLS handshake each, and never block the event loop.
+    _http = httpx.AsyncClient(
+        http2=True,
+        timeout=60,
+        limits=httpx.Limits(max_keepalive_connections=32),
+    )
+    _writer = threading.Thread(target=_writer_loop, name="session-brain-writer", daemon=True)
+    _writer.start()
+    sweeper = asyncio.create_task(sweep_forever())
+    yield
+    sweeper.cancel()
+    # flush inserts still queued for the writer before shutdown completes
+    _write_queue.put(None)
+    await asyncio.to_thread(_writer.join)
+    await _http.aclose()
+
+
+class OrjsonResponse(JSONResponse):
+    """
+    JSON rendered by orjson. Endpoints return it directly, which also skips FastAPI's response-model
+    validation and jsonable_encoder pass over dicts they just built.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+
+app = FastAPI(title=APP_NAME, lifespan=lifespan, default_response_class=OrjsonResponse)
 
 
 def now_ms() -> int:
     return int(time.time() * 1000)
 
 
-def ensure_db() -> None:
+def connect_db() -> sqlite3.Connection:
+    # Keep the SQL text of hot statements constant so they hit the per-connection statement cache
+    con = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
+    con.execute("PRAGMA busy_timeout=5000")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA mmap_size=268435456")
+    return con
+
+
+def ensure_db() -> sqlite3.Connection:
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    with sqlite3.connect(DB_PATH) as con:
+    con = connect_db()
+    # WAL is persistent in the db file: readers no longer block the writer and commits skip the rollback journal
+    con.execute("PRAGMA journal_mode=WAL")
+    with con:
         con.execute(
             """
         CREATE TABLE IF NOT EXISTS events (
@@ -78,8 +148,12 @@ def ensure_db() -> None:
         """
         )
         con.execute("CREATE INDEX IF NOT EXISTS idx_events_ts ON events(ts_ms)")
-        con.execute("CREATE INDEX IF NOT EXISTS idx_events_ip ON events(ip)")
-        con.execute("CREATE INDEX IF NOT EXISTS idx_events_session ON events(session)")
+        # (ip|session, ts_ms) serve the filtered range scans and their ORDER BY ts_ms without a sort;
+        # the old single-column indexes are redundant prefixes of these.
+        con.execute("CREATE INDEX IF NOT EXISTS idx_events_ip_ts ON events(ip, ts_ms)")
+        con.execute("CREATE INDEX IF NOT EXISTS idx_events_session_ts ON events(session, ts_ms)")
+        con.execute("DROP INDEX IF EXISTS idx_events_ip")
+        con.execute("DROP INDEX IF EXISTS idx_events_session")
 
         con.execute(
             """
@@ -95,10 +169,122 @@ def ensure_db() -> None:
         """
         )
         con.execute("CREATE INDEX IF NOT EXISTS idx_decisions_ts ON decisions(ts_ms)")
-        con.commit()
+    return con
 
 
-ensure_db()
+INSERT_EVENT_SQL = (
+    "INSERT INTO events(ts_ms, ip, session, endpoint, status, latency_ms, backend, error, raw_json) "
+    "VALUES (?,?,?,?,?,?,?,?,?)"
+)
+INSERT_DECISION_SQL = "INSERT INTO decisions(ts_ms, kind, target, ttl_sec, reason, evidence_json) VALUES (?,?,?,?,?,?)"
+
+# Single long-lived writer connection, used only by the writer thread that lifespan starts.
+_db = ensure_db()
+_write_queue: "queue.Queue[Optional[Tuple[str, tuple, Future]]]" = queue.Queue()  # None stops the writer
+
+
+def submit_write(sql: str, params: tuple) -> "Future[int]":
+    """Queue an INSERT for the batched writer; the future resolves to its row id once committed."""
+    fut: "Future[int]" = Future()
+    _write_queue.put((sql, params, fut))
+    return fut
+
+
+def _decision_row(params: tuple) -> tuple:
+    *cols, evidence = params
+    return (*cols, orjson.dumps(evidence).decode())
+
+
+# Per-statement row encoders run on the writer thread, so serialization stays off the request path
+_ROW_ENCODERS = {INSERT_DECISION_SQL: _decision_row}
+
+
+def _insert_rows_one_by_one(
+    cur: sqlite3.Cursor, groups: Dict[str, List[Tuple[tuple, Future]]]
+) -> Tuple[List[Tuple[Future, int]], List[Tuple[Future, Exception]]]:
+    """Retry a failed batch row by row, each under its own savepoint, so one bad row fails only itself."""
+    done: List[Tuple[Future, int]] = []
+    failed: List[Tuple[Future, Exception]] = []
+    for sql, items in groups.items():
+        encode = _ROW_ENCODERS.get(sql)
+        for params, fut in items:
+            cur.execute("SAVEPOINT write_row")
+            try:
+                cur.execute(sql, encode(params) if encode else params)
+            except Exception as exc:
+                cur.execute("ROLLBACK TO write_row")
+                failed.append((fut, exc))
+            else:
+                done.append((fut, cur.lastrowid))
+            cur.execute("RELEASE write_row")
+    return done, failed
+
+
+def _commit_batch(cur: sqlite3.Cursor, batch: List[Tuple[str, tuple, Future]]) -> None:
+    """Insert one batch in a single transaction and resolve its futures."""
+    groups: Dict[str, List[Tuple[tuple, Future]]] = {}
+    for sql, params, fut in batch:
+        groups.setdefault(sql, []).append((params, fut))
+    done: List[Tuple[Future, int]] = []
+    failed: List[Tuple[Future, Exception]] = []
+    try:
+        with _db:
+            # the savepoint opens the transaction, so a failed executemany can be undone without ending it
+            cur.execute("SAVEPOINT write_batch")
+            try:
+                for sql, items in groups.items():
+                    encode = _ROW_ENCODERS.get(sql)
+                    cur.executemany(sql, [encode(params) if encode else params for params, _ in items])
+                    # executemany() leaves cur.lastrowid unset; rowids within one write transaction are contiguous
+                    first_id = cur.execute("SELECT last_insert_rowid()").fetchone()[0] - len(items) + 1
+                    done.extend((fut, first_id + i) for i, (_, fut) in enumerate(items))
+            except Exception:
+                cur.execute("ROLLBACK TO write_batch")
+                retry = True
+            else:
+                retry = False
+            if retry:
+                done, failed = _insert_rows_one_by_one(cur, groups)
+    except Exception as exc:
+        for _, _, fut in batch:
+            if fut.set_running_or_notify_cancel():
+                fut.set_exception(exc)
+        return
+    # a caller that gave up (e.g. a cancelled request) has cancelled its future; the row is still written
+    for fut, row_id in done:
+        if fut.set_running_or_notify_cancel():
+            fut.set_result(row_id)
+    for fut, exc in failed:
+        if fut.set_running_or_notify_cancel():
+            fut.set_exception(exc)
+
+
+def _writer_loop() -> None:
+    """
+    Drain queued inserts and commit them in one transaction per batch (group commit). A None on the
+    queue ends the loop once everything queued ahead of it is committed.
+    """
+    cur = _db.cursor()
+    while True:
+        batch = []
+        item = _write_queue.get()
+        while item is not None:
+            batch.append(item)
+            if len(batch) >= WRITE_BATCH_MAX:
+                break
+            try:
+                item = _write_queue.get_nowait()
+            except queue.Empty:
+                break
+        if batch:
+            try:
+                _commit_batch(cur, batch)
+            except Exception:
+                # keep draining: a dead writer would leave every later write waiting forever
+                log.exception("write batch failed")
+        if item is None:
+            return
+
 
 
 class EventIn(BaseModel):
@@ -121,84 +307,271 @@ class AnalyzeIn(BaseModel):
     limit: int = 3000
 
 
-# In-memory rolling windows. Persisted history is in SQLite.
-ip_windows: Dict[str, deque] = defaultdict(deque)  # (ts_ms, status, latency_ms, endpoint, error)
+class LatencyHistogram:
+    """
+    Window latencies counted in 1ms buckets (0..LATENCY_HIST_MAX_MS), plus 64ms coarse buckets so a
+    percentile lookup scans the occupied coarse buckets + 64 slots instead of sorting the window.
+    Both are sparse (only non-zero counts are stored), so an IP costs memory for the latencies it
+    actually has. Larger values are kept exactly in a sorted overflow list, so percentiles are never clamped.
+    """
+
+    __slots__ = ("fine", "coarse", "overflow", "total", "over_limit")
+
+    def __init__(self) -> None:
+        self.fine: Dict[int, int] = {}  # ms -> count
+        self.coarse: Dict[int, int] = {}  # ms >> 6 -> count
+        self.overflow: List[int] = []  # sorted latencies > LATENCY_HIST_MAX_MS
+        self.total = 0
+        self.over_limit = 0  # values >= MAX_LATENCY_P95_MS
+
+    def add(self, latency_ms: int, _max_ms: int = LATENCY_HIST_MAX_MS, _limit: int = MAX_LATENCY_P95_MS) -> None:
+        if latency_ms > _max_ms:
+            insort(self.overflow, latency_ms)
+        else:
+            fine, coarse, hi = self.fine, self.coarse, latency_ms >> 6
+            fine[latency_ms] = fine.get(latency_ms, 0) + 1
+            coarse[hi] = coarse.get(hi, 0) + 1
+        self.total += 1
+        if latency_ms >= _limit:
+            self.over_limit += 1
+
+    def remove(self, latency_ms: int, _max_ms: int = LATENCY_HIST_MAX_MS, _limit: int = MAX_LATENCY_P95_MS) -> None:
+        if latency_ms > _max_ms:
+            del self.overflow[bisect_left(self.overflow, latency_ms)]
+        else:
+            fine, coarse, hi = self.fine, self.coarse, latency_ms >> 6
+            if fine[latency_ms] == 1:
+                del fine[latency_ms]
+            else:
+                fine[latency_ms] -= 1
+            if coarse[hi] == 1:
+                del coarse[hi]
+            else:
+                coarse[hi] -= 1
+        self.total -= 1
+        if latency_ms >= _limit:
+            self.over_limit -= 1
+
+    def p95_over_limit(self) -> bool:
+        """percentile(0.95) >= MAX_LATENCY_P95_MS, i.e. at most rank-many values sit below the limit."""
+        n = self.total
+        return n > 0 and n - self.over_limit <= int(round((n - 1) * 0.95))
+
+    def percentile(self, p: float) -> Optional[int]:
+        """Nearest rank round((n - 1) * p) over the sorted values."""
+        if not self.total:
+            return None
+        k = int(round((self.total - 1) * p))
+        in_range = self.total - len(self.overflow)
+        if k >= in_range:
+            return self.overflow[k - in_range]
+        seen = 0
+        for hi in sorted(self.coarse):
+            c = self.coarse[hi]
+            if seen + c > k:
+                fine = self.fine
+                for ms in range(hi << 6, (hi + 1) << 6):
+                    seen += fine.get(ms, 0)
+                    if seen > k:
+                        return ms
+            seen += c
+        raise AssertionError("histogram counts out of sync with total")
+
+
+@dataclass(slots=True)
+class WindowBucket:
+    """Events of one wall-clock second inside an IPWindow."""
+
+    count: int = 0
+    status_429: int = 0
+    status_5xx: int = 0
+    disconnect_like: int = 0
+    latency_ms: array = field(default_factory=lambda: array("H"))  # known latencies <= LATENCY_HIST_MAX_MS
+    overflow_ms: Optional[List[int]] = None  # known latencies above it, rare
+
+
+@dataclass(slots=True)
+class IPWindow:
+    """
+    Rolling window for one IP as one-second buckets keyed by epoch second, created on the first
+    event of that second and dropped when it leaves the window. Window totals are maintained as
+    events arrive and buckets expire, so reading stats never scans the window, and memory per IP
+    is bounded by WINDOW_SEC buckets but only paid for seconds that saw traffic.
+    """
+
+    buckets: Dict[int, WindowBucket] = field(default_factory=dict)
+    newest_sec: Optional[int] = None
+    count: int = 0
+    status_429: int = 0
+    status_5xx: int = 0
+    disconnect_like: int = 0
+    latency: LatencyHistogram = field(default_factory=LatencyHistogram)
+    # maybe_decide found nothing last time and nothing since could change that: only events that
+    # stay under every threshold were added (they can't push a counter or the p95 over) and nothing expired
+    settled: bool = False
+    blocked_until: int = 0  # expires_ts_ms of this IP's entry in active_blocks, 0 if none
+    touched_ms: int = 0  # server time of the last event, so sweeping never trusts client timestamps
+
+    def __len__(self) -> int:
+        return self.count
+
+
+# In-memory rolling windows, striped over shards by IP hash. Persisted history is in SQLite.
+# A window is only touched with its shard's lock held, so ingests for different IPs never
+# contend and an IP's window update + block decision is atomic.
+WINDOW_SHARDS = 16  # power of two
+window_shards: List[Dict[str, IPWindow]] = [{} for _ in range(WINDOW_SHARDS)]
+shard_locks: List[threading.Lock] = [threading.Lock() for _ in range(WINDOW_SHARDS)]
 active_blocks: Dict[str, int] = {}  # ip -> expires_ts_ms
 
 
-def prune_window(q: deque, cutoff_ts_ms: int) -> None:
-    while q and q[0][0] < cutoff_ts_ms:
-        q.popleft()
-
-
-def percentile(values: List[int], p: float) -> Optional[int]:
-    if not values:
-        return None
-    s = sorted(values)
-    k = int(round((len(s) - 1) * p))
-    return s[max(0, min(k, len(s) - 1))]
-
-
-def record_event(e: EventIn) -> int:
-    ts_ms = e.ts_ms if e.ts_ms is not None else now_ms()
-    raw = e.model_dump()
-    raw["ts_ms"] = ts_ms
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.execute(
-            "INSERT INTO events(ts_ms, ip, session, endpoint, status, latency_ms, backend, error, raw_json) VALUES (?,?,?,?,?,?,?,?,?)",
-            (
-                ts_ms,
-                e.ip,
-                e.session,
-                e.endpoint,
-                e.status,
-                e.latency_ms,
-                e.backend,
-                e.error,
-                json.dumps(raw, ensure_ascii=False),
-            ),
-        )
-        con.commit()
-        return int(cur.lastrowid)
+def shard_index(ip: str) -> int:
+    return hash(ip) & (WINDOW_SHARDS - 1)
+
+
+def prune_window(w: IPWindow, sec: int, _window_sec: int = WINDOW_SEC) -> None:
+    """Slide the window forward to end at `sec`, expiring every bucket that falls out of it."""
+    if w.newest_sec is not None:
+        # live buckets are within (newest_sec - W, newest_sec]; those <= sec - W expire
+        for s in range(w.newest_sec - _window_sec + 1, min(w.newest_sec, sec - _window_sec) + 1):
+            b = w.buckets.pop(s, None)
+            if b is None:
+                continue
+            w.settled = False
+            w.count -= b.count
+            w.status_429 -= b.status_429
+            w.status_5xx -= b.status_5xx
+            w.disconnect_like -= b.disconnect_like
+            for ms in b.latency_ms:
+                w.latency.remove(ms)
+            if b.overflow_ms:
+                for ms in b.overflow_ms:
+                    w.latency.remove(ms)
+    w.newest_sec = sec
+
+
+_NULL_TS_PREFIX = '{"ts_ms":null'
+
+
+def record_event(e: EventIn) -> "Future[int]":
+    # pydantic serializes straight to JSON without an intermediate dict; ts_ms is the first field,
+    # so a server-assigned timestamp is spliced in place of its leading null.
+    raw_json = e.model_dump_json()
+    if e.ts_ms is None:
+        ts_ms = now_ms()
+        if raw_json.startswith(_NULL_TS_PREFIX):
+            raw_json = f'{{"ts_ms":{ts_ms}{raw_json[len(_NULL_TS_PREFIX):]}'
+        else:
+            raw_json = e.model_copy(update={"ts_ms": ts_ms}).model_dump_json()
+    else:
+        ts_ms = e.ts_ms
+    return submit_write(
+        INSERT_EVENT_SQL,
+        (
+            ts_ms,
+            e.ip,
+            e.session,
+            e.endpoint,
+            e.status,
+            e.latency_ms,
+            e.backend,
+            e.error,
+            raw_json,
+        ),
+    )
 
 
-def add_to_windows(e: EventIn) -> None:
-    ts_ms = e.ts_ms if e.ts_ms is not None else now_ms()
-    item = (ts_ms, e.status, e.latency_ms or -1, e.endpoint or "", e.error or "")
-    cutoff = ts_ms - WINDOW_SEC * 1000
-    w = ip_windows[e.ip]
-    w.append(item)
-    prune_window(w, cutoff)
+def add_to_windows(
+    e: EventIn,
+    _window_sec: int = WINDOW_SEC,
+    _disconnect_bits: int = _DISCONNECT_BITS,
+    _max_ms: int = LATENCY_HIST_MAX_MS,
+    _p95_limit: int = MAX_LATENCY_P95_MS,
+) -> None:
+    # Hot path: config is bound as default args (resolved once at import) so reads are LOAD_FAST, not LOAD_GLOBAL.
+    now = now_ms()
+    # a client clock ahead of ours must not drag the window into the future and drop current events as late
+    sec = (e.ts_ms if e.ts_ms is not None and e.ts_ms < now else now) // 1000
+    shard = window_shards[shard_index(e.ip)]
+    w = shard.get(e.ip)
+    if w is None:
+        # a swept window may come back while its block is still active
+        w = shard[e.ip] = IPWindow(blocked_until=active_blocks.get(e.ip, 0))
+    if w.newest_sec is None or sec > w.newest_sec:
+        prune_window(w, sec)
+    elif sec <= w.newest_sec - _window_sec:
+        return  # late event, already outside the window
+    w.touched_ms = now
+
+    b = w.buckets.get(sec)
+    if b is None:
+        b = w.buckets[sec] = WindowBucket()
+    status = e.status
+    b.count += 1
+    w.count += 1
+    if status == 429:
+        b.status_429 += 1
+        w.status_429 += 1
+        w.settled = False
+    if 500 <= status <= 599:
+        b.status_5xx += 1
+        w.status_5xx += 1
+        w.settled = False
+    if status >= 0 and (_disconnect_bits >> status) & 1:
+        b.disconnect_like += 1
+        w.disconnect_like += 1
+        w.settled = False
+    if e.latency_ms and e.latency_ms > 0:
+        latency = e.latency_ms
+        if latency <= _max_ms:
+            b.latency_ms.append(latency)
+        elif b.overflow_ms is None:
+            b.overflow_ms = [latency]
+        else:
+            b.overflow_ms.append(latency)
+        w.latency.add(latency)
+        if latency >= _p95_limit:
+            w.settled = False
 
 
 def compute_ip_stats(ip: str) -> Dict[str, Any]:
-    w = ip_windows.get(ip)
+    w = window_shards[shard_index(ip)].get(ip)
     if not w:
         return {"ip": ip, "window_sec": WINDOW_SEC, "count": 0}
 
-    statuses = [x[1] for x in w]
-    latencies = [x[2] for x in w if x[2] >= 0]
-
-    c429 = sum(1 for s in statuses if s == 429)
-    c5xx = sum(1 for s in statuses if 500 <= s <= 599)
-    cdisc = sum(1 for s in statuses if s in DISCONNECT_STATUS)
-    p95 = percentile(latencies, 0.95) if latencies else None
-
     return {
         "ip": ip,
         "window_sec": WINDOW_SEC,
         "count": len(w),
-        "status_429": c429,
-        "status_5xx": c5xx,
-        "disconnect_like": cdisc,
-        "latency_p95_ms": p95,
+        "status_429": w.status_429,
+        "status_5xx": w.status_5xx,
+        "disconnect_like": w.disconnect_like,
+        "latency_p95_ms": w.latency.percentile(0.95),
     }
 
 
-def maybe_decide(ip: str) -> Optional[Dict[str, Any]]:
-    # skip if already blocked
-    exp = active_blocks.get(ip)
-    if exp and exp > now_ms():
+def maybe_decide(
+    ip: str,
+    _max_429: int = MAX_429_PER_WINDOW,
+    _max_5xx: int = MAX_5XX_PER_WINDOW,
+    _max_disconnect: int = MAX_TIMEOUTS_PER_WINDOW,
+) -> Optional[Dict[str, Any]]:
+    w = window_shards[shard_index(ip)].get(ip)
+    if not w or w.settled:
+        return None
+    # skip if already blocked (mirrored on the window, so unblocked IPs never probe active_blocks)
+    if w.blocked_until and w.blocked_until > now_ms():
+        return None
+
+    # Reuse the previous "nothing to do" verdict while it still holds, else gate on the running
+    # counters; the stats dict (and the p95 lookup) is only built when something fires.
+    if (
+        w.status_429 < _max_429
+        and w.status_5xx < _max_5xx
+        and w.disconnect_like < _max_disconnect
+        and not w.latency.p95_over_limit()
+    ):
+        w.settled = True
         return None
 
     st = compute_ip_stats(ip)
@@ -227,32 +600,103 @@ def maybe_decide(ip: str) -> Optional[Dict[str, Any]]:
         "evidence": evidence,
     }
 
-    # persist decision + activate block
-    with sqlite3.connect(DB_PATH) as con:
-        con.execute(
-            "INSERT INTO decisions(ts_ms, kind, target, ttl_sec, reason, evidence_json) VALUES (?,?,?,?,?,?)",
-            (
-                decision["ts_ms"],
-                decision["kind"],
-                decision["target"],
-                decision["ttl_sec"],
-                decision["reason"],
-                json.dumps(decision["evidence"], ensure_ascii=False),
-            ),
-        )
-        con.commit()
-
-    active_blocks[ip] = decision["ts_ms"] + decision["ttl_sec"] * 1000
+    # activate block, then queue the decision row (evidence is encoded by the writer) without waiting on it
+    w.blocked_until = active_blocks[ip] = decision["ts_ms"] + decision["ttl_sec"] * 1000
+    fut = submit_write(
+        INSERT_DECISION_SQL,
+        (
+            decision["ts_ms"],
+            decision["kind"],
+            decision["target"],
+            decision["ttl_sec"],
+            decision["reason"],
+            decision["evidence"],
+        ),
+    )
+    fut.add_done_callback(_log_decision_write)
     return decision
 
 
-def call_gemini(prompt: str) -> str:
+def _log_decision_write(fut: "Future[int]") -> None:
+    exc = fut.exception()
+    if exc is not None:
+        log.error("failed to persist decision", exc_info=exc)
+
+
+def sweep_state() -> None:
+    """Drop expired blocks and windows with no event for WINDOW_SEC of server time, bounding memory by active IPs."""
+    t = now_ms()
+    for ip, exp in list(active_blocks.items()):
+        if exp <= t:
+            del active_blocks[ip]
+    idle_ms = t - WINDOW_SEC * 1000
+    for shard, lock in zip(window_shards, shard_locks):
+        with lock:
+            for ip in [ip for ip, w in shard.items() if w.touched_ms <= idle_ms]:
+                del shard[ip]
+
+
+async def sweep_forever() -> None:
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL_SEC)
+        sweep_state()
+
+
+def fetch_all(sql: str, params: Any = ()) -> List[tuple]:
+    """Blocking read on a fresh connection; endpoints run it via asyncio.to_thread."""
+    with connect_db() as con:
+        return con.execute(sql, params).fetchall()
+
+
+_PROMPT_EVENT_FIELDS = ("ts_ms", "ip", "session", "endpoint", "status", "latency_ms", "backend", "error")
+
+
+def load_analysis(where: str, params: List[Any], limit: int) -> Tuple[Dict[str, Any], int, str]:
+    """
+    Aggregate the first `limit` matching events in SQL and encode only the last 200 of them as a JSON
+    array for the prompt, all from one read snapshot. Returns (stats, events_in_prompt, events_json).
+    Blocking; endpoints run it via asyncio.to_thread.
+    """
+    window = f"SELECT status, latency_ms FROM events {where} ORDER BY ts_ms ASC LIMIT ?"
+    args = [*params, limit]
+    with connect_db() as con:
+        con.execute("BEGIN")
+        count, c429, c5xx, cdisc, n_lat = con.execute(
+            "SELECT COUNT(*), IFNULL(SUM(status = 429), 0), IFNULL(SUM(status BETWEEN 500 AND 599), 0), "
+            f"IFNULL(SUM(status IN ({_DISCONNECT_SQL})), 0), COUNT(latency_ms) FROM ({window})",
+            args,
+        ).fetchone()
+        p95 = None
+        if n_lat:
+            # nearest rank, same as LatencyHistogram.percentile
+            p95 = con.execute(
+                f"SELECT latency_ms FROM ({window}) WHERE latency_ms IS NOT NULL ORDER BY latency_ms LIMIT 1 OFFSET ?",
+                [*args, int(round((n_lat - 1) * 0.95))],
+            ).fetchone()[0]
+        tail = min(count, 200)
+        cur = con.execute(
+            f"SELECT {', '.join(_PROMPT_EVENT_FIELDS)} FROM events {where} ORDER BY ts_ms ASC LIMIT ? OFFSET ?",
+            [*params, tail, count - tail],
+        )
+        events = b",".join(orjson.dumps(dict(zip(_PROMPT_EVENT_FIELDS, r))) for r in cur)
+        con.rollback()
+    stats = {
+        "count": count,
+        "status_429": c429,
+        "status_5xx": c5xx,
+        "disconnect_like": cdisc,
+        "latency_p95_ms": p95,
+    }
+    return stats, tail, (b"[" + events + b"]").decode()
+
+
+async def call_gemini(prompt: str) -> str:
     if not GEMINI_API_KEY or not GEMINI_MODEL:
         raise RuntimeError("Gemini not configured. Set GEMINI_API_KEY and GEMINI_MODEL.")
     url = GEMINI_ENDPOINT.format(model=GEMINI_MODEL)
     headers = {"x-goog-api-key": GEMINI_API_KEY, "Content-Type": "application/json"}
     body = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
-    r = requests.post(url, headers=headers, json=body, timeout=60)
+    r = await _http.post(url, headers=headers, json=body)
     if r.status_code >= 300:
         raise RuntimeError(f"Gemini error {r.status_code}: {r.text[:1000]}")
     data = r.json()
@@ -263,20 +707,22 @@ def call_gemini(prompt: str) -> str:
 
 
 @app.post("/event")
-def ingest_event(e: EventIn) -> Dict[str, Any]:
-    event_id = record_event(e)
-    add_to_windows(e)
-    decision = maybe_decide(e.ip)
-    return {"ok": True, "event_id": event_id, "decision": decision}
+async def ingest_event(e: EventIn) -> OrjsonResponse:
+    written = record_event(e)
+    with shard_locks[shard_index(e.ip)]:
+        add_to_windows(e)
+        decision = maybe_decide(e.ip)
+    event_id = await asyncio.wrap_future(written)
+    return OrjsonResponse({"ok": True, "event_id": event_id, "decision": decision})
 
 
 @app.get("/decisions")
-def list_decisions(limit: int = 200) -> Dict[str, Any]:
-    with sqlite3.connect(DB_PATH) as con:
-        rows = con.execute(
-            "SELECT ts_ms, kind, target, ttl_sec, reason, evidence_json FROM decisions ORDER BY ts_ms DESC LIMIT ?",
-            (limit,),
-        ).fetchall()
+async def list_decisions(limit: int = 200) -> OrjsonResponse:
+    rows = await asyncio.to_thread(
+        fetch_all,
+        "SELECT ts_ms, kind, target, ttl_sec, reason, evidence_json FROM decisions ORDER BY ts_ms DESC LIMIT ?",
+        (limit,),
+    )
     out = []
     for r in rows:
         out.append(
@@ -286,21 +732,21 @@ def list_decisions(limit: int = 200) -> Dict[str, Any]:
                 "target": r[2],
                 "ttl_sec": r[3],
                 "reason": r[4],
-                "evidence": json.loads(r[5]) if r[5] else {},
+                "evidence": orjson.loads(r[5]) if r[5] else {},
             }
         )
-    return {"decisions": out}
+    return OrjsonResponse({"decisions": out})
 
 
 @app.get("/blocks")
-def list_blocks() -> Dict[str, Any]:
+async def list_blocks() -> OrjsonResponse:
     t = now_ms()
     active = {ip: exp for ip, exp in active_blocks.items() if exp > t}
-    return {"active_blocks": active, "now_ms": t}
+    return OrjsonResponse({"active_blocks": active, "now_ms": t})
 
 
 @app.post("/analyze")
-def analyze(filters: AnalyzeIn) -> Dict[str, Any]:
+async def analyze(filters: AnalyzeIn) -> OrjsonResponse:
     to_ts = filters.to_ts_ms or now_ms()
     from_ts = filters.from_ts_ms or (to_ts - 3600_000)  # default: last hour
 
@@ -313,40 +759,13 @@ def analyze(filters: AnalyzeIn) -> Dict[str, Any]:
         where += " AND session = ?"
         params.append(filters.session)
 
-    q = f"SELECT ts_ms, ip, session, endpoint, status, latency_ms, backend, error FROM events {where} ORDER BY ts_ms ASC LIMIT ?"
-    params.append(filters.limit)
-    with sqlite3.connect(DB_PATH) as con:
-        rows = con.execute(q, params).fetchall()
-
-    events = [
-        {
-            "ts_ms": r[0],
-            "ip": r[1],
-            "session": r[2],
-            "endpoint": r[3],
-            "status": r[4],
-            "latency_ms": r[5],
-            "backend": r[6],
-            "error": r[7],
-        }
-        for r in rows
-    ]
-
-    statuses = [e["status"] for e in events if isinstance(e.get("status"), int)]
-    lat = [e["latency_ms"] for e in events if isinstance(e.get("latency_ms"), int)]
-    stats = {
-        "count": len(events),
-        "status_429": sum(1 for s in statuses if s == 429),
-        "status_5xx": sum(1 for s in statuses if 500 <= s <= 599),
-        "disconnect_like": sum(1 for s in statuses if s in DISCONNECT_STATUS),
-        "latency_p95_ms": percentile(lat, 0.95) if lat else None,
-    }
+    stats, n_events, events_json = await asyncio.to_thread(load_analysis, where, params, filters.limit)
 
     prompt = (
         "You are an SRE assistant. Analyze the following events and explain likely root causes.\n"
         "Return: short summary + key points + suggested actions.\n\n"
-        f"Stats: {json.dumps(stats, ensure_ascii=False)}\n"
-        f"Events (last {min(len(events), 200)}): {json.dumps(events[-200:], ensure_ascii=False)}\n"
+        f"Stats: {orjson.dumps(stats).decode()}\n"
+        f"Events (last {n_events}): {events_json}\n"
     )
 
     used_gemini = False
@@ -357,7 +776,7 @@ def analyze(filters: AnalyzeIn) -> Dict[str, Any]:
     if GEMINI_API_KEY and GEMINI_MODEL:
         try:
             used_gemini = True
-            text = call_gemini(prompt)
+            text = await call_gemini(prompt)
             lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
             summary = "\n".join(lines[:6]) if lines else text
             key_points = [ln.lstrip("-• ").strip() for ln in lines if ln.startswith(("-", "•"))][:12]
@@ -381,13 +800,15 @@ def analyze(filters: AnalyzeIn) -> Dict[str, Any]:
             "Inspect logs around the spike window",
         ]
 
-    return {
-        "used_gemini": used_gemini,
-        "summary": summary[:2000],
-        "key_points": key_points,
-        "suggested_actions": suggested_actions,
-        "supporting_stats": stats,
-    }
+    return OrjsonResponse(
+        {
+            "used_gemini": used_gemini,
+            "summary": summary[:2000],
+            "key_points": key_points,
+            "suggested_actions": suggested_actions,
+            "supporting_stats": stats,
+        }
+    )
 
 
 